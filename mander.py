@@ -1,6 +1,9 @@
+import asyncio
+import contextlib
 import signal
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import os
+import random
 import subprocess
 import argparse
 import time
@@ -8,187 +11,304 @@ import logging
 import re
 
 logging.basicConfig(format='MANDER:%(levelname)s:%(message)s', level=logging.INFO)
+log = logging.getLogger(__name__)
 
 
 RENDER_OUTPUT_BASE_DIR = 'C:\\blender_files\\renders'
 SCRIPT_START_TIMESTAMP = time.strftime('%Y%m%d-%H%M%S')
+SCENE_FRAMES_EXPR = re.compile(rb"__MANDER__(-?\d+),(-?\d+)")  # printed by the get_scene_frames bpy script
+FRAME_FILENAME_EXPR = re.compile(r"(\d+)\.[^.]+")  # fullmatch against a file name: "0001.png"
+# Blender renders get their own process group so Ctrl-C only reaches the manager, which then terminates them.
+NEW_PROCESS_GROUP = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP} if os.name == 'nt' \
+    else {'start_new_session': True}
+RUNNING_BLENDER_PROCS = set()
+TERMINAL_EXIT_CODES = frozenset({0, 1})  # Blender finished, or failed in a way a retry won't fix
+MAX_RETRY_DELAY = 60  # seconds. cap on the exponential backoff between retries
+# max bytes in one line of Blender output. asyncio's 64 KiB default raises ValueError on longer (valid) lines
+BLENDER_LINE_LIMIT = 64 * 1024 * 1024
 # TODO: make platform-agnostic (use os.path more)
-# TODO: instead of waiting on Blender Proc, start async and continuously monitor Blender process. forward kill events
 # TODO: Resume "fills in" the missing frames, wherever in the sequence they are missing.
 
 #####################
 # Manager Arguments #
 #####################
+def positive_int(value: str) -> int:
+    error = argparse.ArgumentTypeError(f'expected a whole number >= 1, got {value!r}')
+    try:
+        number = int(value)
+    except ValueError:
+        raise error from None
+    if number < 1:
+        raise error
+    return number
+
+
 parser = argparse.ArgumentParser(
     description='MANage RenDERing an animation. If Blender crashes, restart where it left off.')
-parser.add_argument('project_file', help='path to the Blender project file (.blend)', type=str)
+parser.add_argument('project_files', help='path(s) to the Blender project file(s) (.blend)', type=str, nargs='+')
 parser.add_argument('--max_retry', help='Maximum number of times to retry rendering  (default: %(default)s)',
                     type=int, default=10)
 parser.add_argument('--resume_dir',
                     help='Resume rendering the project in specified directory instead of creating new dir  (Optional)',
                     type=str)
+parser.add_argument('--parallel',
+                    help='Maximum number of projects to render at once. Env: MANDER_PARALLEL  (default: %(default)s)',
+                    type=positive_int, default=os.environ.get('MANDER_PARALLEL', '1'))  # str default: type validates it
 
 
-@dataclass
+@dataclass(slots=True)
 class BlenderCmd:
     project_file_path: str
     frame_output_path: str
     start_frame: int
     end_frame: int
     animate: bool
+    _argv: list[str] = field(init=False, repr=False, compare=False)
+
+    _start_frame_idx = 4  # positions of the --frame-start/--frame-end values in _argv
+    _end_frame_idx = 6
+
+    def __post_init__(self):
+        self._argv = ["blender", "-b", str(self.project_file_path)]
+        self._argv += ["--frame-start", str(self.start_frame)]
+        self._argv += ["--frame-end", str(self.end_frame)]
+        self._argv += ["--render-output", str(self.frame_output_path)]
+        if self.animate:
+            self._argv.append("-a")
 
     @property
     def command_line(self) -> list[str]:
-        blender_cmd = ["blender", "-b", str(self.project_file_path)]
-        blender_cmd += ["--frame-start", str(self.start_frame)]
-        blender_cmd += ["--frame-end", str(self.end_frame)]
-        blender_cmd += ["--render-output", str(self.frame_output_path)]
-        if self.animate:
-            blender_cmd.append("-a")
-        return blender_cmd
+        self._argv[self._start_frame_idx] = str(self.start_frame)
+        self._argv[self._end_frame_idx] = str(self.end_frame)
+        return self._argv
 
 
-def run(blender_cmd: BlenderCmd,
-        max_retries: int = 10,
-        resume: bool = False):
+async def run(blender_cmd: BlenderCmd,
+              max_retries: int = 10,
+              resume: bool = False):
     exit_code, num_retries = None, 0
+    frames_rendered = get_frame_numbers_in_dir(blender_cmd.frame_output_path) if resume else set()
+    writer = BlenderLineInterpreter(rendered_frames=frames_rendered)  # keeps frames_rendered up to date from here on
     if resume:
-        frames_rendered = get_frame_numbers_in_dir(blender_cmd.frame_output_path)
-        last_frame = max(frames_rendered) if frames_rendered else 0
-        blender_cmd.start_frame = last_frame + 1
-    else:
-        frames_rendered = []
-
-    while exit_code not in [0, 1] and blender_cmd.end_frame not in frames_rendered and num_retries < max_retries:
-        writer = BlenderLineInterpreter()
-        logging.info(f"Blender Command: {' '.join(blender_cmd.command_line)}")
-        proc = subprocess.Popen(blender_cmd.command_line, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        exit_code = proc.poll()
-        while True:
-            stdout = proc.stdout.readline()
-            if stdout == b'' and exit_code is not None:
-                break
-            if stdout:
-                writer.summarize(stdout.decode().strip())
-            exit_code = proc.poll()
-
-        frames_rendered = get_frame_numbers_in_dir(blender_cmd.frame_output_path)
-        report_success(proc, blender_cmd)
+        blender_cmd.start_frame = writer.highest_frame + 1
+
+    while exit_code not in TERMINAL_EXIT_CODES and blender_cmd.end_frame not in frames_rendered \
+            and num_retries < max_retries:
+        if num_retries:  # back off (with jitter) so a GPU driver in a bad state can recover before the respawn
+            delay = min(2 ** num_retries, MAX_RETRY_DELAY) + random.random()
+            log.info("Waiting %.1fs before retrying", delay)
+            await asyncio.sleep(delay)
+
+        if log.isEnabledFor(logging.INFO):
+            log.info("Blender Command: %s", ' '.join(blender_cmd.command_line))
+        proc = await asyncio.create_subprocess_exec(*blender_cmd.command_line,
+                                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                                    limit=BLENDER_LINE_LIMIT, **NEW_PROCESS_GROUP)
+        RUNNING_BLENDER_PROCS.add(proc)
+        try:
+            async for stdout in proc.stdout:
+                writer.summarize(stdout.decode(errors='replace').strip())  # cp1252 paths aren't UTF-8
+            exit_code = await proc.wait()
+        finally:  # on an error or cancellation, don't leave Blender rendering (and holding the GPU) in its own session
+            terminate(proc)
+            await proc.wait()
+            RUNNING_BLENDER_PROCS.discard(proc)
+
+        report_success(proc, len(frames_rendered))
 
         if exit_code != 0:
             num_retries += 1
-            frames_rendered = get_frame_numbers_in_dir(blender_cmd.frame_output_path)
-            last_frame = max(frames_rendered) if frames_rendered else 0
-            logging.error(f'returncode: {proc.returncode}. Failed at frame: {last_frame + 1}. '
-                          f'retrying {max_retries - num_retries} more times...')
+            log.error('returncode: %s. Failed at frame: %d. retrying %d more times...',
+                      proc.returncode, writer.highest_frame + 1, max_retries - num_retries)
             if num_retries < max_retries:
-                blender_cmd.start_frame = last_frame + 1
+                blender_cmd.start_frame = writer.highest_frame + 1
 
 
-def report_success(completed_proc, blender_cmd: BlenderCmd):
+def report_success(completed_proc, num_rendered: int):
     # print(completed_proc.stdout.decode())
-    logging.info(f"Frames Rendered:{len(get_frame_numbers_in_dir(blender_cmd.frame_output_path))}")
-    logging.debug("Manager completed with returncode: " + str(completed_proc.returncode))
+    log.info("Frames Rendered:%d", num_rendered)
+    log.debug("Manager completed with returncode: %s", completed_proc.returncode)
 
 
-def get_scene_frames(project_path) -> (int, int):
+async def get_scene_frames(project_path) -> (int, int):
     bpy_script = ";".join([
         "import bpy",
-        "print(f'start_frame={bpy.context.scene.frame_start}\\nend_frame={bpy.context.scene.frame_end}')"
+        "print(f'__MANDER__{bpy.context.scene.frame_start},{bpy.context.scene.frame_end}')"
     ])
-    cmd = f'blender -b {project_path} --python-expr "{bpy_script}"'
-    start_frame = None
-    end_frame = None
+    # --factory-startup skips user prefs/addons: the probe only reads two scene properties, so don't pay their load time
+    cmd = ["blender", "-b", "--factory-startup", project_path, "--python-expr", bpy_script]
+    proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                                limit=BLENDER_LINE_LIMIT)
+    match = None
+    async for line in proc.stdout:  # raw bytes; no need to decode Blender's startup log for one token
+        if match := SCENE_FRAMES_EXPR.match(line):
+            break
+
+    if match is not None:  # got the token, don't wait for Blender to shut down
+        terminate(proc)
+    await proc.wait()
+
+    if match is None:
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+        raise KeyError("Unable to find start/end frames in blender output.")
+
+    return int(match[1]), int(match[2])
+
+
+def get_frame_numbers_in_dir(directory_path: str) -> set[int]:
+    # Cold path: only seeds a resume. While rendering, BlenderLineInterpreter learns of each new frame from Blender's
+    # "Saved:" line, which is already an event stream, so there's no directory polling (or watcher) to replace.
     try:
-        completed_proc = subprocess.run(cmd, check=True, capture_output=True)
-        lines = completed_proc.stdout.decode().splitlines()
-        for line in lines:
-            if line.startswith("start_frame="):
-                start_frame = int(line.split("start_frame=")[1])
-            elif line.startswith("end_frame="):
-                end_frame = int(line.split("end_frame=")[1])
+        entries = os.scandir(directory_path)
+    except (FileNotFoundError, NotADirectoryError):
+        return set()
 
-        if None in [start_frame, end_frame]:
-            raise KeyError("Unable to find start/end frames in blender output.")
+    with entries:
+        return {int(match[1]) for entry in entries
+                if entry.is_file() and (match := FRAME_FILENAME_EXPR.fullmatch(entry.name))}
 
-        return start_frame, end_frame
 
-    except (subprocess.CalledProcessError, KeyError) as e:
-        logging.error(f'MANAGER QUIT. UNABLE TO GET FRAMES ON PROJECT: {project_path} \n {e}')
-        exit(1)
-
-
-def get_frame_numbers_in_dir(directory_path: str) -> list[int]:
-    if not os.path.isdir(directory_path):
-        return []
-
-    filenames = [f for f in os.listdir(directory_path) if os.path.isfile(os.path.join(directory_path, f))]
-    frames = [int(f.rsplit('.', maxsplit=1)[0]) for f in filenames]
-    return frames
+def frame_number(filename: str) -> int | None:
+    # same rule as get_frame_numbers_in_dir, so e.g. multiview "0001_L.png" is skipped by both rather than crashing
+    match = FRAME_FILENAME_EXPR.fullmatch(os.path.basename(filename))
+    return int(match[1]) if match else None
 
 
-def new_frame_output_dir(project_file_path: str):
-    name = project_file_path.split("\\")[-1].split(".blend")[0]
-    project_render_dir = '_'.join([name, SCRIPT_START_TIMESTAMP])
-    return os.path.join(RENDER_OUTPUT_BASE_DIR, project_render_dir)
+def new_frame_output_dir(project_file_path: str, taken: set[str]):
+    # projects sharing a file name (x/scene.blend, y/scene.blend) get _2, _3, ... so they don't overwrite each other
+    name = os.path.splitext(os.path.basename(project_file_path))[0]
+    project_render_dir = os.path.join(RENDER_OUTPUT_BASE_DIR, f"{name}_{SCRIPT_START_TIMESTAMP}")
+    candidate, n = project_render_dir, 1
+    while os.path.normcase(candidate) in taken:
+        n += 1
+        candidate = f"{project_render_dir}_{n}"
+    taken.add(os.path.normcase(candidate))
+    return candidate
 
 
 class BlenderLineInterpreter:
     saved_expr = re.compile(r"Saved: '(.+)'")
-    time_expr = re.compile(r"Time: (\d+:?\d+:\d+\.\d+) \(Saving: (\d+:?\d+:\d+\.\d+)\)")
+    time_expr = re.compile(r"Time: ((?:\d+:)?\d\d:\d\d\.\d+) \(Saving: ((?:\d+:)?\d\d:\d\d\.\d+)\)")  # [HH:]MM:SS.ss
+    fra_clock_interval = 32  # only consult the clock on every Nth "Fra:" line; they arrive many times per second.
 
-    def __init__(self, status_message_frequency: int = 30):
+    def __init__(self, status_message_frequency: int = 30, rendered_frames: set[int] = None):
         self.status_msg_freq = status_message_frequency  # max freq of frame-render status messages. still alive msg.
-        self.last_report_time = time.time()
+        self._next_fra_deadline = time.monotonic() + self.status_msg_freq
+        self._fra_skip = 0
+        self.rendered_frames = rendered_frames if rendered_frames is not None else set()  # updated per "Saved:" line
+        self.highest_frame = max(self.rendered_frames, default=0)
 
         self.saved_filename = None
         self.render_time = None
 
+        # line prefix (text before the first ':') -> handler. One dict lookup per line instead of a startswith chain.
+        self._dispatch = {'Saved': self._on_saved, 'Fra': self._on_fra, 'Time': self._on_time}
+
     def summarize(self, line: str):
-        logging.debug(line)
+        if log.isEnabledFor(logging.DEBUG):  # hit on every line of Blender output
+            log.debug("%s", line)
+
+        handler = self._dispatch.get(line.partition(':')[0])
+        if handler is not None:
+            handler(line)
+
+    def _on_saved(self, line: str):
+        try:
+            self.saved_filename = self.saved_expr.match(line).group(1)
+        except (AttributeError, IndexError):
+            self.saved_filename = f"Unrecognized Saved File Path: {line}"  # probably never hit this
+        else:
+            if (frame := frame_number(self.saved_filename)) is None:
+                return
+            self.rendered_frames.add(frame)
+            if frame > self.highest_frame:
+                self.highest_frame = frame
+
+    def _on_fra(self, line: str):
+        self._fra_skip += 1
+        if self._fra_skip < self.fra_clock_interval:
+            return
+
+        self._fra_skip = 0
+        if (now := time.monotonic()) >= self._next_fra_deadline:
+            print(line)
+            self._next_fra_deadline = now + self.status_msg_freq
 
-        if line.startswith('Saved:'):
-            try:
-                self.saved_filename = self.saved_expr.match(line).group(1)
-            except (AttributeError, IndexError):
-                self.saved_filename = f"Unrecognized Saved File Path: {line}"  # probably never hit this
+    def _on_time(self, line: str):
+        try:
+            self.render_time = self.time_expr.match(line).group(1)
+        except (AttributeError, IndexError):
+            self.render_time = f"Unrecognized Render Time: {line}"  # probably never hit this
 
-        elif line.startswith("Fra:") and (current_time := time.time()) - self.last_report_time > self.status_msg_freq:
-            print(line)
-            self.last_report_time = current_time
+        # "Time: ..." Indicates final log message for a frame. Print cached stuff.
+        print(f"{self.saved_filename}: {self.render_time}")
+        self._next_fra_deadline = time.monotonic() + self.status_msg_freq
 
-        elif line.startswith('Time:'):
-            try:
-                self.render_time = self.time_expr.match(line).group(1)
-            except (AttributeError, IndexError):
-                self.render_time = f"Unrecognized Render Time: {line}"  # probably never hit this
 
-            # "Time: ..." Indicates final log message for a frame. Print cached stuff.
-            print(f"{self.saved_filename}: {self.render_time}")
-            self.last_report_time = time.time()
+def terminate(proc: asyncio.subprocess.Process):
+    # os.kill rather than proc.terminate(): Popen.send_signal() polls, which can reap the child out from under
+    # asyncio's child watcher when several Blender processes are running. On Windows this is TerminateProcess.
+    if proc.returncode is None:
+        with contextlib.suppress(ProcessLookupError):
+            os.kill(proc.pid, signal.SIGTERM)
 
 
 def sig_handler(*_):
     print('Ctrl-C Received. Exiting...')
+    for proc in RUNNING_BLENDER_PROCS:  # release the GPU now rather than after Blender's current frame
+        terminate(proc)
     exit(1)
 
 
 signal.signal(signal.SIGINT, sig_handler)
 
 
-if __name__ == '__main__':
-    args = parser.parse_args()
-    project_file = os.path.abspath(args.project_file)
-    frame_output_dir = os.path.abspath(args.resume_dir) \
-        if args.resume_dir \
-        else new_frame_output_dir(project_file)
-    start, end = get_scene_frames(project_file)
+async def render_project(project_file: str, frame_output_dir: str, args,
+                         probe_slots: asyncio.Semaphore, render_slots: asyncio.Semaphore) -> bool:
+    try:
+        async with probe_slots:  # its own limit, not render_slots: probe while other projects render
+            start, end = await get_scene_frames(project_file)
+    except (subprocess.CalledProcessError, KeyError) as e:
+        # only this project is skipped; renders of the other projects carry on
+        log.error('SKIPPING PROJECT. UNABLE TO GET FRAMES ON PROJECT: %s \n %s', project_file, e)
+        return False
     managed_cmd = BlenderCmd(
         project_file_path=project_file,
-        frame_output_path=frame_output_dir if frame_output_dir.endswith('\\') else frame_output_dir + '\\',
+        frame_output_path=os.path.join(frame_output_dir, ''),  # trailing separator: Blender names frames 0001.png etc.
         start_frame=start,
         end_frame=end,
         animate=True
     )
 
-    run(managed_cmd, max_retries=args.max_retry, resume=bool(args.resume_dir))
+    async with render_slots:
+        await run(managed_cmd, max_retries=args.max_retry, resume=bool(args.resume_dir))
+    return True
+
+
+async def main(args) -> bool:
+    # run sig_handler from the event loop. Windows loops can't, so the signal.signal handler above stays in place there
+    with contextlib.suppress(NotImplementedError):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGINT, sig_handler)
+
+    project_files = [os.path.abspath(project_file) for project_file in args.project_files]
+    taken_output_dirs = set()
+    frame_output_dirs = [os.path.abspath(args.resume_dir)] \
+        if args.resume_dir \
+        else [new_frame_output_dir(project_file, taken_output_dirs) for project_file in project_files]
+
+    # each probe loads its whole .blend too, so a batch of N files mustn't start N probe Blenders at once
+    probe_slots = asyncio.Semaphore(args.parallel)
+    render_slots = asyncio.Semaphore(args.parallel)  # size to the number of GPUs; more would oversubscribe them
+    rendered = await asyncio.gather(*(render_project(project_file, frame_output_dir, args, probe_slots, render_slots)
+                                      for project_file, frame_output_dir in zip(project_files, frame_output_dirs)))
+    return all(rendered)
+
+
+if __name__ == '__main__':
+    cli_args = parser.parse_args()
+    if cli_args.resume_dir and len(cli_args.project_files) > 1:
+        parser.error('--resume_dir can only be used with a single project file')
+
+    if not asyncio.run(main(cli_args)):
+        exit(1)